@@ -4,17 +4,22 @@ geocoding and reverse geocoding functionalities, as well as the inclusion of ave
 features.
 """
 import json
+import asyncio
 import numpy as np
 import pandas as pd
 from pathlib import Path
 
 from tqdm import tqdm
 from loguru import logger
-from warnings import simplefilter
 from geopy.geocoders import Nominatim, Photon
-from geopy.exc import GeocoderUnavailable
+from geopy.adapters import AioHTTPAdapter, RequestsAdapter
+from geopy.exc import GeocoderServiceError
+from geopy.extra.rate_limiter import AsyncRateLimiter, RateLimiter
 
 from src.setup.config import config
+from src.feature_pipeline.geocoding_cache import (
+    make_place_key, make_coordinate_key, get_cached_results, cache_results
+)
 from src.setup.paths import MIXED_INDEXER, ROUNDING_INDEXER
                       
 
@@ -28,9 +33,22 @@ class Geocoder:
     def __init__(self, data: pd.DataFrame, scenario: str) -> None:
         self.data = data
         self.scenario = scenario
-        self.latitudes = []
-        self.longitudes = []
-        self.place_names = self.data[f"{scenario}_station_name"].unique().to_list()
+        self.place_names = self.data[f"{scenario}_station_name"].dropna().unique().tolist()
+
+        # One instance of each geocoder, so that the underlying requests.Session (and its keep-alive connection)
+        # is reused across queries instead of a fresh TCP/TLS handshake being made for every place name.
+        self.nominatim = Nominatim(user_agent=config.email, adapter_factory=RequestsAdapter)
+        self.photon = Photon(adapter_factory=RequestsAdapter)
+
+        # Nominatim's usage policy allows no more than one request per second. Failed queries are not re-issued 
+        # (geopy would otherwise retry each of them twice, waiting 5 seconds each time).
+        self.geocode_with_nominatim = RateLimiter(
+            self.nominatim.geocode, min_delay_seconds=1, max_retries=0, swallow_exceptions=False
+        )
+
+        self.geocode_with_photon = RateLimiter(
+            self.photon.geocode, min_delay_seconds=1, max_retries=0, swallow_exceptions=False
+        )
 
     def geocode(self) -> dict:
         """
@@ -50,23 +68,45 @@ class Geocoder:
             dict: a dictionary which contains key value pairs of place names and
                   coordinates
         """
-        def _trigger_geocoder(geocoder: Nominatim | Photon, place_names: list) -> dict:
+        def _trigger_geocoder(rate_limited_geocoder: RateLimiter, place_names: list) -> dict:
             places_and_points = {}
+            newly_geocoded_places = {}
+            cached_points = get_cached_results(keys=[make_place_key(place) for place in place_names])
+
             for place in place_names:
                 if place in places_and_points.keys():  # The same geocoding request will not be made twice
                     continue
+
+                # Places that were geocoded successfully in previous runs are not sent to the geocoder again
+                if make_place_key(place) in cached_points.keys():
+                    places_and_points[f"{place}"] = cached_points[make_place_key(place)]
+                    continue
+                
+                try:
+                    location = rate_limited_geocoder(place, timeout=120)
+                except GeocoderServiceError as error:  # Includes timeouts and unavailable services
+                    logger.error(f"Failed to geocode {place}: {error}")
+                    places_and_points[f"{place}"] = (0, 0)
+                    continue
+
+                if location is None:
+                    logger.error(f"Failed to geocode {place}")
+                    places_and_points[f"{place}"] = (0, 0)
                 else:
-                    try:
-                        places_and_points[f"{place}"] = geocoder.geocode(place, timeout=120)[-1]
-                    except geocoder.geocode(place, timeout=120) is None:
-                        logger.error(f"Failed to geocode {place}")
-                        places_and_points[f"{place}"] = (0, 0)
+                    places_and_points[f"{place}"] = location[-1]
+                    newly_geocoded_places[make_place_key(place)] = location[-1]
 
+            cache_results(keys_and_results=newly_geocoded_places)
             return places_and_points
 
-        nominatim_results = _trigger_geocoder(geocoder=Nominatim(user_agent=config.email), place_names=self.place_names)
-        places_missed_by_nominatim = [key for key, value in nominatim_results if value == (0, 0)]
-        final_places_and_points = _trigger_geocoder(geocoder=Photon(), place_names=places_missed_by_nominatim)
+        nominatim_results = _trigger_geocoder(rate_limited_geocoder=self.geocode_with_nominatim, place_names=self.place_names)
+        places_missed_by_nominatim = [key for key, value in nominatim_results.items() if value == (0, 0)]
+        photon_results = _trigger_geocoder(
+            rate_limited_geocoder=self.geocode_with_photon, 
+            place_names=places_missed_by_nominatim
+        )
+
+        final_places_and_points = {**nominatim_results, **photon_results}
         return final_places_and_points
 
     def add_latitudes_and_longitudes(self) -> pd.DataFrame:
@@ -76,15 +116,15 @@ class Geocoder:
         a target dataframe.
         """
         places_and_points = self.geocode()
+        points = self.data[f"{self.scenario}_station_name"].map(places_and_points)
 
-        for place in self.place_names:
-            if place in places_and_points.keys():
-                geodata.latitudes.append(places_and_points[place][0])
-                geodata.longitudes.append(places_and_points[place][0])
+        self.data[[f"{self.scenario}_latitude", f"{self.scenario}_longitude"]] = pd.DataFrame(
+            data=[point if isinstance(point, tuple) else (np.nan, np.nan) for point in points],
+            index=self.data.index,
+            dtype="float32"
+        )
 
-        self.data[f"{self.scenario}_latitude"] = pd.Series(geodata.latitudes)
-        self.data[f"{self.scenario}_longitude"] = pd.Series(geodata.longitudes) 
-        return features
+        return self.data
 
 class ReverseGeocoder:
     """
@@ -113,6 +153,63 @@ class ReverseGeocoder:
         else:
             return name
 
+    @staticmethod
+    async def _reverse_geocode_concurrently(coordinates: list[tuple[float, float]]) -> dict[str, tuple[float, float]]:
+        """
+        Send reverse geocoding requests for all the provided coordinates to Nominatim concurrently (subject to its 
+        rate limit), rather than waiting for each response before making the next request. Those coordinates that 
+        Nominatim fails to process are then sent to Photon in the same manner.
+
+        Args:
+            coordinates (list[tuple[float, float]]): the unique coordinates that are to be reverse geocoded.
+
+        Returns:
+            dict[str, tuple[float, float]]: the obtained addresses and their corresponding coordinates. 
+        """
+        names_and_coordinates = {}
+
+        async with Nominatim(user_agent=config.email, adapter_factory=AioHTTPAdapter) as nominatim, \
+                Photon(user_agent=config.email, adapter_factory=AioHTTPAdapter) as photon:
+
+            # Failures are raised rather than retried or swallowed, so that gather returns them as exceptions
+            reverse_with_nominatim = AsyncRateLimiter(
+                nominatim.reverse, min_delay_seconds=1, max_retries=0, swallow_exceptions=False
+            )
+
+            reverse_with_photon = AsyncRateLimiter(
+                photon.reverse, min_delay_seconds=1, max_retries=0, swallow_exceptions=False
+            )
+
+            nominatim_results = await asyncio.gather(
+                *[reverse_with_nominatim(coordinate, timeout=120) for coordinate in coordinates],
+                return_exceptions=True
+            )
+
+            coordinates_missed_by_nominatim = []
+            for coordinate, result in zip(coordinates, nominatim_results):
+                if result is None or isinstance(result, Exception):
+                    coordinates_missed_by_nominatim.append(coordinate)
+                else:
+                    names_and_coordinates[str(result)] = coordinate
+
+            if len(coordinates_missed_by_nominatim) != 0:
+                logger.warning(
+                    f"Nominatim was unable to process {len(coordinates_missed_by_nominatim)} coordinates. Trying with Photon"
+                )
+
+                photon_results = await asyncio.gather(
+                    *[reverse_with_photon(coordinate, timeout=120) for coordinate in coordinates_missed_by_nominatim],
+                    return_exceptions=True
+                )
+
+                for coordinate, result in zip(coordinates_missed_by_nominatim, photon_results):
+                    if isinstance(result, Exception):
+                        logger.error(f"Failed to reverse geocode {coordinate}: {result}")
+                    elif result is not None:
+                        names_and_coordinates[str(result)] = coordinate
+
+        return names_and_coordinates
+
     def reverse_geocode_rounded_coordinates(self, using_mixed_indexer: bool) -> list[dict[str, list[float] | str]]:
         """
         Perform reverse geocoding of each coordinate in the dataframe (avoiding duplicates), and make and return a
@@ -131,32 +228,42 @@ class ReverseGeocoder:
             with open(save_path, mode="r") as file:
                 new_station_names_and_coordinates = json.load(file)        
 
-        photon = Photon(user_agent=config.email)
         nominatim = Nominatim(user_agent=config.email)
         column_of_rounded_coordinates = self.data[f"rounded_{self.scenario}_coordinates"]
         initial_number_of_new_names_and_coordinates = len(new_station_names_and_coordinates)
 
-        place_not_already_identified = np.isin(
-            element=self.data[f"rounded_{self.scenario}_coordinates"].to_list(),
-            test_elements=[tuple(point) for point in new_station_names_and_coordinates.values()],
-            invert=True
-        )
-        
-        if True in place_not_already_identified:
-            for coordinate in tqdm(
-                iterable=column_of_rounded_coordinates.loc[place_not_already_identified], 
-                desc="Reverse geocoding..."
-            ):
-                try:
-                    nominatim_try = str(nominatim.reverse(query=coordinate, timeout=120))
-                    if nominatim_try == "None":
-                        logger.warning(f"Nominatim was unable to process {coordinate}. Trying with Photon")
-                        photon_try = str(photon.reverse(query=coordinate, timeout=120))
-                        new_station_names_and_coordinates[photon_try] = coordinate
-                    else:                
-                        new_station_names_and_coordinates[nominatim_try] = coordinate
-                except GeocoderUnavailable as error:
-                    logger.error(error)
+        # Deduplicate the coordinates up front (preserving their order), and use a set for the membership checks.
+        identified_coordinates = {tuple(point) for point in new_station_names_and_coordinates.values()}
+        unidentified_coordinates = [
+            coordinate for coordinate in dict.fromkeys(map(tuple, column_of_rounded_coordinates))
+            if coordinate not in identified_coordinates
+        ]
+
+        if len(unidentified_coordinates) != 0:
+
+            # Addresses obtained during previous runs are taken from the cache instead of being requested again 
+            cached_names = get_cached_results(
+                keys=[make_coordinate_key(coordinate) for coordinate in unidentified_coordinates]
+            )
+
+            coordinates_to_reverse_geocode = []
+            for coordinate in unidentified_coordinates:
+                if make_coordinate_key(coordinate) in cached_names.keys():
+                    new_station_names_and_coordinates[cached_names[make_coordinate_key(coordinate)]] = coordinate
+                else:
+                    coordinates_to_reverse_geocode.append(coordinate)
+
+            logger.info(f"Reverse geocoding {len(coordinates_to_reverse_geocode)} coordinates...")
+            newly_named_coordinates = asyncio.run(
+                self._reverse_geocode_concurrently(coordinates=coordinates_to_reverse_geocode)
+            )
+
+            new_station_names_and_coordinates.update(newly_named_coordinates)
+            cache_results(
+                keys_and_results={
+                    make_coordinate_key(coordinate): name for name, coordinate in newly_named_coordinates.items()
+                }
+            )
 
         coordinates_and_new_station_names = {
             tuple(coordinate): self._shorten_place_name(name=name) for name, coordinate in 
@@ -206,24 +313,22 @@ class ReverseGeocoder:
         new_addresses_and_coordinates: list[dict[str, list[float] | str]],
         saved_geodata:  list[dict[str, list[float] | str]]
     ):
-        established_ids = []
-        for station_information in tqdm(iterable=saved_geodata, desc="Finding established IDs"):
-            station_id = station_information["station_id"]
-            if station_id not in established_ids:
-                established_ids.append(station_id)
+        established_ids = {station_information["station_id"] for station_information in saved_geodata}
 
+        # Start after the largest established ID, as the established IDs need not be contiguous.
+        first_new_id = max(established_ids) + 1
         new_ids = np.arange(
-            start=max(established_ids) + 1,
-            stop=len(established_ids) + len(new_addresses_and_coordinates) + 1
+            start=first_new_id,
+            stop=first_new_id + len(new_addresses_and_coordinates),
+            dtype=np.int32
         )
 
-        new_id_index = 0
-        for new_information in tqdm(
-            iterable=new_addresses_and_coordinates, 
+        for new_information, new_id in tqdm(
+            iterable=zip(new_addresses_and_coordinates, new_ids), 
+            total=len(new_addresses_and_coordinates),
             desc="Making IDs for the newly identified stations"
         ):
-            new_information["station_id"] = new_ids[new_id_index]
-            new_id_index += 1
+            new_information["station_id"] = int(new_id)
 
         return new_addresses_and_coordinates
         
@@ -238,29 +343,51 @@ class ReverseGeocoder:
             new_addresses_and_coordinates=new_addresses_and_coordinates
         )
 
-        return saved_geodata.extend(new_addresses_and_coordinates)
+        # list.extend works in place and returns None, so the extended list has to be returned separately
+        saved_geodata.extend(new_addresses_and_coordinates)
+        return saved_geodata
 
 
-def add_avg_trips_last_4_weeks(features: pd.DataFrame) -> pd.DataFrame:
+def add_avg_trips_last_4_weeks(features: pd.DataFrame, lag_matrix: np.ndarray | None = None) -> pd.DataFrame:
     """
     Include a column for the average number of trips in the past 4 weeks.
 
+    Args:
+        features: the features of our dataset
+        lag_matrix: the trip counts from each of the previous hours as a single array whose rows match those of the
+                    features (with the columns in the same order as the "trips_previous_..." columns). If it isn't 
+                    provided, the relevant columns will be extracted from the features.
+
     Returns:
         pd.DataFrame: the modified dataframe
     """
     if "average_trips_last_4_weeks" not in features.columns:
-        simplefilter(action="ignore", category=pd.errors.PerformanceWarning)
-        averages = 0.25 * (
-                features[f"trips_previous_{1 * 7 * 24}_hour"] +
-                features[f"trips_previous_{2 * 7 * 24}_hour"] +
-                features[f"trips_previous_{3 * 7 * 24}_hour"] +
-                features[f"trips_previous_{4 * 7 * 24}_hour"]
-        )
+        hours_in_previous_weeks = [week * 7 * 24 for week in range(1, 5)]
 
-        features.insert(
-            loc=features.shape[1],
-            column="average_trips_last_4_weeks",
-            value=averages
+        if lag_matrix is None:
+            weekly_trips = features[
+                [f"trips_previous_{hours}_hour" for hours in hours_in_previous_weeks]
+            ].to_numpy(dtype=np.float32)
+        else:
+            # The column of trips from n hours before is n columns from the end, as the oldest hours come first.
+            input_seq_len = lag_matrix.shape[1]
+
+            # Otherwise, the negative positions would silently wrap around to the wrong columns
+            if input_seq_len < hours_in_previous_weeks[-1]:
+                raise ValueError(
+                    f"The average over the last 4 weeks needs at least {hours_in_previous_weeks[-1]} hours of " 
+                    f"previous trips, but only {input_seq_len} were provided"
+                )
+
+            weekly_trips = lag_matrix[:, [input_seq_len - hours for hours in hours_in_previous_weeks]]
+
+        averages = weekly_trips.mean(axis=1)
+
+        # Inserting a column into such a wide dataframe fragments it, so the new column is concatenated instead.
+        features = pd.concat(
+            [features, pd.Series(averages, name="average_trips_last_4_weeks", index=features.index)],
+            axis=1,
+            copy=False
         )
 
     return features
@@ -277,22 +404,20 @@ def add_hours_and_days(features: pd.DataFrame, scenario: str) -> pd.DataFrame:
     # The values in this column change types when uploading to Hopsworks, so this avoids errors.
     features[f"{scenario}_hour"] = pd.to_datetime(features[f"{scenario}_hour"], errors="coerce")
 
-    times_and_entries = {
-        "hour": features[f"{scenario}_hour"].apply(lambda x: x.hour),
-        "day_of_the_week": features[f"{scenario}_hour"].apply(lambda x: x.dayofweek)
-    }
-
-    for time in times_and_entries.keys():
-        features.insert(
-            loc=features.shape[1],
-            column=time,
-            value=times_and_entries[time]
-        )
+    # The .dt accessor works on the underlying datetime64 array rather than calling a function on each row
+    hours = features[f"{scenario}_hour"].dt.hour.astype("int8")
+    days_of_the_week = features[f"{scenario}_hour"].dt.dayofweek.astype("int8")
 
+    features = features.assign(hour=hours, day_of_the_week=days_of_the_week)
     return features.drop(f"{scenario}_hour", axis=1)
 
 
-def finish_feature_engineering(features: pd.DataFrame, scenario: str, geocode: bool) -> pd.DataFrame:
+def finish_feature_engineering(
+    features: pd.DataFrame, 
+    scenario: str, 
+    geocode: bool, 
+    lag_matrix: np.ndarray | None = None
+) -> pd.DataFrame:
     """
     Initiate a chain of events that results in the accomplishment of the above feature
     engineering steps.
@@ -302,13 +427,14 @@ def finish_feature_engineering(features: pd.DataFrame, scenario: str, geocode: b
         scenario: whether we are looking at the starts or the ends of trips (enter "start" or "end")
         geocode: whether we want to initiate the geocoding procedures. This is only necessary if the
                  latitudes and longitudes have not already been provided.
+        lag_matrix: the array of trip counts from previous hours that the features were built from (if available).
 
     Returns:
         pd.DataFrame: a dataframe containing the pre-existing features as well as the new ones.
     """
     logger.warning(f"Initiating feature engineering for the {config.displayed_scenario_names[scenario].lower()}")
     features_with_hours_and_days = add_hours_and_days(features=features, scenario=scenario)
-    final_features = add_avg_trips_last_4_weeks(features=features_with_hours_and_days)
+    final_features = add_avg_trips_last_4_weeks(features=features_with_hours_and_days, lag_matrix=lag_matrix)
 
     assert "day_of_the_week" and "average_trips_last_4_weeks" in final_features.columns
     assert final_features["day_of_the_week"].isna().sum() == 0 and \
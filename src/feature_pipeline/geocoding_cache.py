@@ -0,0 +1,66 @@
+"""
+A persistent, on-disk cache of the results of geocoding and reverse geocoding requests. 
+
+Divvy's set of stations changes slowly, so each rerun of the geocoders would otherwise send the same requests
+to Nominatim and Photon for place names and coordinates that have already been processed. Checking this cache
+first means that only the genuinely new places incur network calls (and the associated rate limits).
+"""
+import shelve
+
+from src.setup.paths import GEOCODING_CACHE, make_fundamental_paths
+
+
+def make_place_key(place: str) -> str:
+    """
+    Normalise a place name so that trivial differences in whitespace or capitalisation still hit the same entry.
+
+    Args:
+        place (str): the name of the place being geocoded
+
+    Returns:
+        str: the key under which the coordinates of the place are cached
+    """
+    return place.strip().lower()
+
+
+def make_coordinate_key(coordinate: tuple[float, float]) -> str:
+    """
+    Round the latitude and longitude to 5 decimal places (about 1m), so that microscopic floating point noise 
+    still hits the same entry. Shelve only accepts strings as keys.
+
+    Args:
+        coordinate (tuple[float, float]): the coordinate being reverse geocoded
+
+    Returns:
+        str: the key under which the address of the coordinate is cached
+    """
+    latitude, longitude = coordinate
+    return f"{round(latitude, 5)},{round(longitude, 5)}"
+
+
+def get_cached_results(keys: list[str]) -> dict[str, tuple[float, float] | str]:
+    """
+    Look up several keys at once, so that the cache file is only opened once.
+
+    Args:
+        keys (list[str]): the normalised keys of the places or coordinates in question
+
+    Returns:
+        dict[str, tuple[float, float] | str]: the cached results for those keys that are present in the cache
+    """
+    make_fundamental_paths()
+    with shelve.open(str(GEOCODING_CACHE / "geocode"), flag="c") as cache:
+        return {key: cache[key] for key in keys if key in cache}
+
+
+def cache_results(keys_and_results: dict[str, tuple[float, float] | str]) -> None:
+    """
+    Save newly obtained geocoding or reverse geocoding results to the cache.
+
+    Args:
+        keys_and_results (dict[str, tuple[float, float] | str]): the normalised keys and their results
+    """
+    if len(keys_and_results) != 0:
+        make_fundamental_paths()
+        with shelve.open(str(GEOCODING_CACHE / "geocode"), flag="c") as cache:
+            cache.update(keys_and_results)
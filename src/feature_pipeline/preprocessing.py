@@ -110,13 +110,13 @@ class DataProcessor:
                     step_size=1
                 )
 
-                training_sets.append(training_data)
-
             else:
                 logger.success(f"You already have training data for the {config.displayed_scenario_names[scenario]}")  
-            
-            continue
-            return training_sets
+                training_data = pd.read_parquet(TRAINING_DATA/f"{scenario}s.parquet")
+
+            training_sets.append(training_data)
+
+        return training_sets
 
     def make_time_series(self) -> tuple[pd.DataFrame, pd.DataFrame]:
         """
@@ -447,7 +447,8 @@ class DataProcessor:
             scenario: str,
             step_size: int,
             input_seq_len: int,
-            ts_data: pd.DataFrame
+            ts_data: pd.DataFrame,
+            save: bool = True
     ) -> pd.DataFrame:
         """
         Transpose the time series data into a feature-target format.
@@ -458,6 +459,7 @@ class DataProcessor:
             step_size: the step size to be used by the standard cutoff indexer.
             input_seq_len: the input sequence length to be used to construct the training data
             ts_data: the full time series dataset for arrivals and departures
+            save: whether we wish to save the generated training data
 
         Returns:
             pd.DataFrame: the training data for arrivals or departures
@@ -468,8 +470,7 @@ class DataProcessor:
         # Ensure first that these are the columns of the chosen data set (and they are listed in this order)
         assert set(ts_data.columns) == {f"{scenario}_hour", f"{scenario}_station_id", "trips"}
 
-        features = pd.DataFrame()
-        targets = pd.DataFrame()
+        lags_per_station, targets_per_station, hours, station_ids = [], [], [], []
 
         for station_id in tqdm(
             iterable=ts_data[f"{scenario}_station_id"].unique(), 
@@ -487,7 +488,6 @@ class DataProcessor:
             x = np.empty(shape=(num_indices, input_seq_len), dtype=np.float32)
             y = np.empty(shape=(num_indices, 1), dtype=np.float32)
 
-            hours = []    
             if use_standard_cutoff_indexer:
                 for i, index in enumerate(indices):
                     hour = ts_per_station.iloc[index[1]][f"{scenario}_hour"]
@@ -509,27 +509,40 @@ class DataProcessor:
                     hour = ts_per_station.iloc[index[1]][f"{scenario}_hour"]
                     hours.append(hour)
 
-            features_per_station = pd.DataFrame(
-                data=x, 
-                columns=[f"trips_previous_{i + 1}_hour" for i in reversed(range(input_seq_len))]
-            )
-            
-            features_per_station[f"{scenario}_hour"] = hours  
-            features_per_station[f"{scenario}_station_id"] = station_id
-            targets_per_station = pd.DataFrame(data=y, columns=["trips_next_hour"])
-
-            features = pd.concat([features, features_per_station], axis=0)
-            targets = pd.concat([targets, targets_per_station], axis=0)
+            lags_per_station.append(x)
+            targets_per_station.append(y)
+            station_ids.append(np.full(shape=num_indices, fill_value=station_id))
 
-        features = features.reset_index(drop=True)
-        targets = targets.reset_index(drop=True)
+        # Keep the lagged trip counts of all stations in one contiguous array rather than concatenating dataframes
+        lag_matrix = np.concatenate(lags_per_station, axis=0)
+        
+        features = pd.DataFrame(
+            data=lag_matrix,
+            columns=[f"trips_previous_{i + 1}_hour" for i in reversed(range(input_seq_len))]
+        )
+
+        features[f"{scenario}_hour"] = hours
+        features[f"{scenario}_station_id"] = np.concatenate(station_ids)
+        targets = pd.DataFrame(data=np.concatenate(targets_per_station, axis=0), columns=["trips_next_hour"])
+
+        engineered_features = finish_feature_engineering(
+            features=features, 
+            scenario=scenario, 
+            geocode=geocode, 
+            lag_matrix=lag_matrix
+        )
 
-        engineered_features = finish_feature_engineering(features=features, scenario=scenario, geocode=geocode)
         training_data = pd.concat([engineered_features, targets["trips_next_hour"]], axis=1)
 
-        logger.success("Saving the data so we (hopefully) won't have to do that again...")
-        final_data_path = INFERENCE_DATA if self.for_inference else TRAINING_DATA
-        training_data.to_parquet(final_data_path / f"{scenario}s.parquet")
+        if save:
+            logger.success("Saving the data so we (hopefully) won't have to do that again...")
+            final_data_path = INFERENCE_DATA if self.for_inference else TRAINING_DATA
+            training_data.to_parquet(final_data_path / f"{scenario}s.parquet")
+
+            # The training data is reloaded for every training run, so an uncompressed Arrow IPC (feather) copy 
+            # is also kept. Unlike parquet, it needs no decoding, and it can be memory-mapped.
+            if not self.for_inference:
+                training_data.to_feather(final_data_path / f"{scenario}s.arrow", compression="uncompressed")
 
         return training_data
 
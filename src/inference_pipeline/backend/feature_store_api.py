@@ -11,6 +11,10 @@ from hsfs.constructor.query import Query
 
 
 class FeatureStoreAPI:
+    # Shared by all instances, so that each process only logs in and resolves each feature view once.
+    _feature_stores: dict[str, FeatureStore] = {}
+    _feature_views: dict[tuple[str, str, int], FeatureView] = {}
+
     def __init__(
         self,
         api_key: str,
@@ -27,13 +31,17 @@ class FeatureStoreAPI:
 
     def get_feature_store(self) -> FeatureStore:
         """
-        Login to Hopsworks and return a pointer to the feature store
+        Login to Hopsworks (if this hasn't already been done for this project) and return a pointer to the 
+        feature store
 
         Returns:
             FeatureStore: pointer to the feature store
         """
-        project = hopsworks.login(project=self.project_name, api_key_value=self.api_key)
-        return project.get_feature_store()
+        if self.project_name not in self._feature_stores:
+            project = hopsworks.login(project=self.project_name, api_key_value=self.api_key)
+            self._feature_stores[self.project_name] = project.get_feature_store()
+
+        return self._feature_stores[self.project_name]
 
     def setup_feature_group(self, name: str, version: int, description: str, for_predictions: bool) -> FeatureGroup:
         """
@@ -64,7 +72,8 @@ class FeatureStoreAPI:
         """
         Creates or alternatively retrieves a feature view using the provided details. If a sub-query is to be used, 
         that has to be indicated, and the sub-query is to be provided. Otherwise, all features will be selected for 
-        retrieval from the associated feature group.
+        retrieval from the associated feature group. Feature views that have already been fetched are reused rather
+        than being requested from Hopsworks again.
 
         Args:
             name: the name of the feature view to fetch or create
@@ -76,7 +85,10 @@ class FeatureStoreAPI:
         Returns:
             FeatureView: the desired feature view
         """
-        
+        cache_key = (self.project_name, name, version)
+        if cache_key in self._feature_views:
+            return self._feature_views[cache_key]
+
         feature_store = self.get_feature_store()
 
         try:
@@ -86,5 +98,6 @@ class FeatureStoreAPI:
         except Exception as error:
             logger.exception(error)
             feature_view = feature_store.get_feature_view(name=name, version=version)
-            
+
+        self._feature_views[cache_key] = feature_view
         return feature_view
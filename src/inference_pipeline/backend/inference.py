@@ -9,11 +9,14 @@ import os
 import json
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
 from pathlib import Path
 
 from loguru import logger
 from argparse import ArgumentParser
+from joblib import Parallel, delayed
 
 from datetime import datetime, timedelta
 from hsfs.feature_group import FeatureGroup
@@ -22,7 +25,7 @@ from hsfs.feature_view import FeatureView
 from sklearn.pipeline import Pipeline
 
 from src.setup.config import FeatureGroupConfig, config
-from src.setup.paths import ROUNDING_INDEXER, MIXED_INDEXER
+from src.setup.paths import ROUNDING_INDEXER, MIXED_INDEXER, INFERENCE_DATA
 
 from src.feature_pipeline.preprocessing import DataProcessor
 from src.feature_pipeline.feature_engineering import finish_feature_engineering
@@ -83,15 +86,17 @@ class InferenceModule:
         )
 
         logger.warning("Fetching time series data from the offline feature store...")
+        # Without Hive, the data is read through Arrow Flight, which transfers it in a columnar format.
         ts_data: pd.DataFrame = feature_view.get_batch_data(
             start_time=start_date, 
             end_time=target_date,
-            read_options={"use_hive": True}
+            read_options={"use_hive": False}
         )
 
-        ts_data = ts_data.sort_values(
-            by=[f"{self.scenario}_station_id", f"{self.scenario}_hour"]
-        )
+        ts_data = sort_with_arrow(data=ts_data, by=[f"{self.scenario}_station_id", f"{self.scenario}_hour"])
+
+        # A few thousand station IDs are repeated across many rows, so store them once (with small integer codes)
+        ts_data[f"{self.scenario}_station_id"] = ts_data[f"{self.scenario}_station_id"].astype("category")
 
         station_ids = ts_data[f"{self.scenario}_station_id"].unique()
         features = self.make_features(station_ids=station_ids, ts_data=ts_data, geocode=geocode)
@@ -102,29 +107,54 @@ class InferenceModule:
         return features
 
 
-    def make_features(self, station_ids: list[int], ts_data: pd.DataFrame, geocode: bool) -> pd.DataFrame:
+    def make_features(
+        self, 
+        station_ids: list[int], 
+        ts_data: pd.DataFrame, 
+        geocode: bool, 
+        stations_per_chunk: int = 100,
+        n_jobs: int = -1
+    ) -> pd.DataFrame:
         """
         Restructure the time series data into features in a way that aligns with the features 
         of the original training data.
 
+        Rather than transforming the entire dataset at once, the stations are processed in chunks. As 
+        the chunks are independent of each other, they are distributed across worker processes.
+
         Args:
             station_ids: the list of unique station IDs.
             ts_data: the time series data that is store on the feature store.
+            geocode: whether to implement geocoding during feature engineering
+            stations_per_chunk: the number of stations whose data is transformed at a time.
+            n_jobs: the number of worker processes to use. Defaults to -1 (all available cores).
 
         Returns:
             pd.DataFrame: time series data
         """
         processor = DataProcessor(year=config.year, for_inference=True)
 
-        # Perform transformation of the time series data with feature engineering
-        return processor.transform_ts_into_training_data(
-            ts_data=ts_data,
-            geocode=geocode,
-            scenario=self.scenario, 
-            input_seq_len=config.n_features,
-            step_size=24
+        # Number each station in order of appearance, and place consecutive groups of stations in the same chunk
+        chunk_numbers = ts_data.groupby(
+            f"{self.scenario}_station_id", sort=False, observed=True
+        ).ngroup() // stations_per_chunk
+
+        # Perform transformation of the time series data with feature engineering (results come back in order).
+        # The chunks are fed to the workers lazily, so that only those which have been dispatched are held in memory.
+        features_per_chunk = Parallel(n_jobs=n_jobs, backend="loky")(
+            delayed(processor.transform_ts_into_training_data)(
+                ts_data=ts_data_per_chunk,
+                geocode=geocode,
+                scenario=self.scenario, 
+                input_seq_len=config.n_features,
+                step_size=24,
+                save=False
+            ) for _, ts_data_per_chunk in ts_data.groupby(chunk_numbers, sort=True)
         )
 
+        features = pd.concat(features_per_chunk, axis=0, ignore_index=True)
+        features.to_parquet(INFERENCE_DATA / f"{self.scenario}s.parquet")
+        return features
 
     def fetch_predictions_group(self, model_name: str) -> FeatureGroup:
         """
@@ -162,9 +192,12 @@ class InferenceModule:
         Returns:
             pd.DataFrame: the dataframe containing predictions.
         """
-        # Ensure these times are datatimes
-        from_hour = pd.to_datetime(from_hour, utc=True)
-        to_hour = pd.to_datetime(to_hour, utc=True)
+        # Ensure these times are UTC datetimes (timezone-aware timestamps only need to be converted)
+        from_hour = from_hour.tz_convert("UTC") if isinstance(from_hour, pd.Timestamp) and from_hour.tzinfo \
+            else pd.to_datetime(from_hour, utc=True)
+
+        to_hour = to_hour.tz_convert("UTC") if isinstance(to_hour, pd.Timestamp) and to_hour.tzinfo \
+            else pd.to_datetime(to_hour, utc=True)
             
         predictions_group = self.fetch_predictions_group(model_name=model_name)
 
@@ -183,11 +216,18 @@ class InferenceModule:
             end_time=to_hour + timedelta(days=1)
         )
 
-        predictions_df[f"{self.scenario}_hour"] = pd.to_datetime(predictions_df[f"{self.scenario}_hour"], utc=True)
+        # The feature store usually returns this column as timezone-aware timestamps already, in which case parsing
+        # the whole column again would be a wasted pass over it.
+        hours = predictions_df[f"{self.scenario}_hour"]
+        if isinstance(hours.dtype, pd.DatetimeTZDtype):
+            if str(hours.dtype.tz) != "UTC":
+                predictions_df[f"{self.scenario}_hour"] = hours.dt.tz_convert("UTC")
+        else:
+            predictions_df[f"{self.scenario}_hour"] = pd.to_datetime(hours, utc=True, cache=True)
 
-        return predictions_df.sort_values(
-            by=[f"{self.scenario}_hour", f"{self.scenario}_station_id"]
-        )
+        predictions_df = sort_with_arrow(data=predictions_df, by=[f"{self.scenario}_hour", f"{self.scenario}_station_id"])
+        predictions_df[f"{self.scenario}_station_id"] = predictions_df[f"{self.scenario}_station_id"].astype("category")
+        return predictions_df
 
     def get_model_predictions(self, model: Pipeline, features: pd.DataFrame) -> pd.DataFrame:
         """
@@ -200,16 +240,52 @@ class InferenceModule:
         Returns:
             pd.DataFrame: the model's predictions
         """
-        predictions = model.predict(features)
-        prediction_per_station = pd.DataFrame()
+        # A float32 frame built from a Fortran-ordered array holds its columns contiguously, which suits the
+        # column-wise way in which the tree-based models read features (and halves the bytes moved).
+        feature_names = getattr(model, "feature_names_in_", features.columns)
+        model_inputs = pd.DataFrame(
+            data=np.asfortranarray(features[feature_names].to_numpy(dtype=np.float32)),
+            columns=feature_names,
+            index=features.index
+        )
 
-        prediction_per_station[f"{self.scenario}_station_id"] = features[f"{self.scenario}_station_id"].values
-        prediction_per_station[f"{self.scenario}_hour"] = pd.to_datetime(datetime.utcnow()).floor("H")
-        prediction_per_station[f"predicted_{self.scenario}s"] = predictions.round(decimals=0)
+        predictions = model.predict(model_inputs)
+        current_hour = pd.Timestamp(datetime.utcnow()).floor("h").to_datetime64()
+
+        # Build the dataframe in one go, with each column's dtype already set, rather than one column at a time.
+        # The rounded predictions are kept as floats, which is how the predictions feature group stores them.
+        prediction_per_station = pd.DataFrame(
+            data={
+                f"{self.scenario}_station_id": features[f"{self.scenario}_station_id"].to_numpy(),
+                f"{self.scenario}_hour": np.full(shape=len(features), fill_value=current_hour, dtype="datetime64[ns]"),
+                f"predicted_{self.scenario}s": np.asarray(predictions, dtype=np.float64).round(decimals=0)
+            }
+        )
         
         return prediction_per_station
 
 
+def sort_with_arrow(data: pd.DataFrame, by: list[str]) -> pd.DataFrame:
+    """
+    Sort a dataframe (in ascending order) using Arrow's multithreaded sort instead of pandas' single-threaded one. 
+    The feature store's query API cannot order the data before sending it, so this is the next best thing. Only 
+    the columns being sorted on are handed to Arrow, and the rows of the dataframe are then reordered just once.
+
+    Args:
+        data: the dataframe to be sorted
+        by: the names of the columns to sort by, in order of priority
+
+    Returns:
+        pd.DataFrame: the sorted dataframe
+    """
+    sorted_indices = pc.sort_indices(
+        pa.Table.from_pandas(data[by], preserve_index=False),
+        sort_keys=[(column, "ascending") for column in by]
+    )
+
+    return data.take(sorted_indices.to_numpy())
+
+
 def rerun_feature_pipeline():
     """
     This is a decorator that provides logic which allows the wrapped function to be run if a certain exception 
@@ -5,7 +5,7 @@ from pathlib import Path
 
 from loguru import logger
 from sklearn.pipeline import Pipeline
-from comet_ml import ExistingExperiment, get_global_experiment, API
+from comet_ml import Experiment, ExistingExperiment, get_global_experiment, API
 
 from src.setup.config import config
 from src.setup.paths import COMET_SAVE_DIR, LOCAL_SAVE_DIR, make_fundamental_paths
@@ -34,19 +34,22 @@ class ModelRegistry:
         model_versions = model_details["versions"][0]["version"]
         return model_versions
 
-    def push_model_to_registry(self, status: str, version: str) -> None:
+    def push_model_to_registry(self, status: str, version: str, experiment: Experiment | None = None) -> None:
         """
         Find the model (saved locally), log it to CometML, and register it at the model registry.
 
         Args:
             status: the status that we want to give to the model during registration.
             version: the version of the model being pushed
+            experiment: the running experiment under which the model is to be logged. If it isn't provided, the
+                        most recently created experiment will be resumed and used.
 
         Returns:
             None
         """
-        running_experiment = get_global_experiment()
-        experiment = ExistingExperiment(api_key=running_experiment.api_key, experiment_key=running_experiment.id)
+        if experiment is None:
+            running_experiment = get_global_experiment()
+            experiment = ExistingExperiment(api_key=running_experiment.api_key, experiment_key=running_experiment.id)
 
         logger.info("Logging model to Comet ML")
         registered_name = self._set_registered_name()
@@ -61,7 +64,7 @@ class ModelRegistry:
     def download_latest_model(self, unzip: bool) -> Pipeline:
         """
         Download the latest version of the requested model to the MODEL_DIR directory,
-        load the file using pickle, and return it.
+        load the file using joblib, and return it.
 
         Args:
             unzip: whether to unzip the downloaded zipfile.
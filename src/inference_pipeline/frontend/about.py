@@ -1,15 +1,29 @@
 import streamlit as st
+from PIL import Image
 from streamlit_extras.colored_header import colored_header
 from src.setup.paths import IMAGES_DIR
 
 
+@st.cache_resource
+def load_profile_image() -> Image.Image:
+    """
+    Read and decode the profile picture once, rather than on every rerun of the page.
+
+    Returns:
+        Image.Image: the decoded image
+    """
+    image = Image.open(IMAGES_DIR/"profile.jpeg")
+    image.load()
+    return image
+
+
 colored_header(label=":violet[About Me]", description="", color_name="green-70")
 
 
 col1, col2, col3 = st.columns([1,2,1])
 
 with col2:
-    st.image(str(IMAGES_DIR/"profile.jpeg"), width=300)
+    st.image(load_profile_image(), width=300)
 
 
 st.markdown(
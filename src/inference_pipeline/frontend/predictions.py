@@ -21,7 +21,7 @@ from src.inference_pipeline.backend.inference import InferenceModule
 from src.inference_pipeline.frontend.data import make_geodataframes, reconcile_geodata
 
 
-@st.cache_data
+@st.cache_data(ttl=3600, show_spinner=False)
 def retrieve_predictions(
     from_hour=config.current_hour - timedelta(hours=1),
     to_hour=config.current_hour
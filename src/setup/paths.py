@@ -19,6 +19,7 @@ GEOGRAPHICAL_DATA = DATA_DIR/"geographical"
 
 ROUNDING_INDEXER = GEOGRAPHICAL_DATA / "rounding_indexer"
 MIXED_INDEXER = GEOGRAPHICAL_DATA / "mixed_indexer"
+GEOCODING_CACHE = GEOGRAPHICAL_DATA / "geocoding_cache"
 
 TIME_SERIES_DATA = TRANSFORMED_DATA/"time_series"
 TRAINING_DATA = TRANSFORMED_DATA/"training_data"
@@ -29,7 +30,7 @@ def make_fundamental_paths() -> None:
     for path in [
         DATA_DIR, CLEANED_DATA, RAW_DATA_DIR, PARQUETS, GEOGRAPHICAL_DATA, TRANSFORMED_DATA, TIME_SERIES_DATA, 
         IMAGES_DIR, TRAINING_DATA, INFERENCE_DATA, MODELS_DIR, LOCAL_SAVE_DIR, COMET_SAVE_DIR, ROUNDING_INDEXER,
-        MIXED_INDEXER
+        MIXED_INDEXER, GEOCODING_CACHE
     ]: 
         if not Path(path).exists():
             os.mkdir(path)
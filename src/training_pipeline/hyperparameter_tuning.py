@@ -4,24 +4,29 @@ that we consider with respect to each of the candidate model architectures. It a
 a function that provides hyperparameter tuning during model training.
 
 """
+import threading
 import numpy as np
-import pandas as pd
 
 from loguru import logger
 from comet_ml import Experiment
 
 import optuna
 from optuna.samplers import TPESampler
-from optuna.pruners import MedianPruner
+from optuna.pruners import SuccessiveHalvingPruner
+from optuna.study import MaxTrialsCallback
+from optuna.trial import TrialState
 
-from sklearn.metrics import mean_absolute_error
+from sklearn import config_context
 from sklearn.model_selection import TimeSeriesSplit
-from sklearn.pipeline import make_pipeline
 
+import xgboost as xgb
+import lightgbm as lgb
 from xgboost import XGBRegressor
 from lightgbm import LGBMRegressor
 from sklearn.linear_model import Lasso
-from src.training_pipeline.models import BaseModel
+from src.training_pipeline.models import (
+    BaseModel, fit_with_cpu_fallback, get_device_params, get_thread_params, compute_mean_absolute_error
+)
 
 
 def sample_hyperparameters(
@@ -66,13 +71,112 @@ def sample_hyperparameters(
         raise NotImplementedError("This model has not been implemented")
 
 
+class EarlyStop:
+    """
+    A study callback which stops the search once the best value has failed to improve over a given 
+    number of consecutive completed trials.
+    """
+    def __init__(self, patience: int):
+        """
+        Args:
+            patience: the number of completed trials without improvement that will be tolerated
+        """
+        self.patience = patience
+        self.best_value = float("inf")
+        self.stale_trials = 0
+
+        # Trials that run in concurrent threads call this object, so its state is updated under a lock
+        self.lock = threading.Lock()
+
+    def __call__(self, study: optuna.study.Study, trial: optuna.trial.FrozenTrial) -> None:
+        # Pruned and failed trials say nothing about whether the search has converged
+        if trial.state != TrialState.COMPLETE:
+            return
+
+        with self.lock:
+            if study.best_value < self.best_value:
+                self.best_value = study.best_value
+                self.stale_trials = 0
+            else:
+                self.stale_trials += 1
+
+            should_stop = self.stale_trials >= self.patience
+
+        if should_stop:
+            logger.warning(f"No improvement in {self.patience} trials -> Stopping the search")
+            study.stop()
+
+
+def make_folds(
+        model_fn: Lasso | LGBMRegressor | XGBRegressor,
+        x: np.ndarray,
+        y: np.ndarray,
+        n_splits: int = 5,
+        feature_names: list[str] | None = None
+) -> list[tuple[lgb.Dataset | xgb.DMatrix | tuple[np.ndarray, np.ndarray], np.ndarray | xgb.DMatrix, np.ndarray]]:
+    """
+    Split the data for time series cross validation, once for all the trials of a study. For the tree boosters, the
+    data is binned a single time, so that the trials don't have to repeat that work on every split. LightGBM's bins
+    are computed once for all the data, and each split's training set is taken from them. XGBoost's are computed 
+    once for each split's training set.
+
+    Args:
+        model_fn: the model architecture to be used
+        x: the array of features
+        y: the array which contains the target variable
+        n_splits: the number of cross validation splits
+        feature_names: the names of the features, which LightGBM will give to the models that it trains
+
+    Returns:
+        list: the training set, validation features, and validation targets of each split
+    """
+    if model_fn == LGBMRegressor:
+        full_set = lgb.Dataset(
+            data=x, 
+            label=y, 
+            feature_name=feature_names or "auto", 
+            free_raw_data=False, 
+            params={"verbose": -1}
+        ).construct()
+
+    folds = []
+    for train_indices, val_indices in TimeSeriesSplit(n_splits=n_splits).split(x):
+        # The indices of each split are contiguous, so the arrays can be sliced into views rather than copied
+        val_split = slice(val_indices[0], val_indices[-1] + 1)
+        x_val, y_val = x[val_split], y[val_split]
+
+        if model_fn == LGBMRegressor:
+            # Subsets reuse the bins of the full dataset. They are constructed now, as the trials may run concurrently.
+            training_set = full_set.subset(used_indices=train_indices.tolist()).construct()
+        elif model_fn == XGBRegressor:
+            # A plain DMatrix builds its histogram index lazily, when it is first trained on, and caches it. That 
+            # isn't safe when concurrent trials share the DMatrix, so the index is built here instead. This relies 
+            # on the "hist" and "gpu_hist" tree methods, which get_device_params always sets.
+            train_split = slice(train_indices[0], train_indices[-1] + 1)
+            training_set = xgb.QuantileDMatrix(data=x[train_split], label=y[train_split])
+            x_val = xgb.DMatrix(data=x_val)
+        else:
+            train_split = slice(train_indices[0], train_indices[-1] + 1)
+            training_set = (x[train_split], y[train_split])
+
+        folds.append((training_set, x_val, y_val))
+
+    return folds
+
+
 def optimise_hyperparameters(
         model_fn: BaseModel | Lasso | LGBMRegressor | XGBRegressor,
         hyperparameter_trials: int,
         experiment: Experiment,
-        x: pd.DataFrame,
-        y: pd.Series
-) -> dict:
+        x: np.ndarray,
+        y: np.ndarray,
+        scenario: str,
+        n_jobs: int = 1,
+        storage: str | None = None,
+        keep_best_model: bool = False,
+        feature_names: list[str] | None = None,
+        threads_per_fit: int | None = None
+) -> tuple[dict, Lasso | LGBMRegressor | XGBRegressor | None]:
     """
     Take a sample of values for each hyperparameter, and define an objective function which is to be
     optimised in an attempt to approximate the minimal MAE (within the set of hyperparameters sampled).
@@ -81,11 +185,24 @@ def optimise_hyperparameters(
         model_fn: the model architecture to be used
         hyperparameter_trials: the number of optuna trials that will be run per mode scenario
         experiment: the CometML experiment object
-        x: the dataframe of features
-        y: the pandas series which contains the target variable
+        x: the array of features
+        y: the array which contains the target variable
+        scenario: "start" or "end". It is used to name the study.
+        n_jobs: the number of trials to run in parallel. Defaults to 1. Passing -1 runs one trial per CPU core.
+        storage: the URL of a database (e.g. "sqlite:///optuna.db" or "mysql://...") in which the study is to be
+                 stored. If several processes point at the same storage, they will share the work of the same study.
+                 Defaults to None, in which case the study is kept in memory.
+        keep_best_model: whether to keep the model that the best trial (of those run by this call) trained on the 
+                         last split, so that it can be used without being refitted. Bear in mind that this split 
+                         leaves out the most recent part of the data. When a model is kept, the hyperparameters 
+                         that are returned (and logged) are those of its trial.
+        feature_names: the names of the features, to be given to the kept LightGBM model.
+        threads_per_fit: the number of threads that each fit of a tree booster may use. Defaults to None, in 
+                         which case each fit uses all the cores.
 
     Returns:
-        dict: the optimal hyperparameters
+        tuple[dict, Lasso | LGBMRegressor | XGBRegressor | None]: the optimal hyperparameters, and the kept model 
+                                                                  (if one was asked for).
     """
     models_and_tags: dict[callable, str] = {
         Lasso: "lasso",
@@ -96,10 +213,19 @@ def optimise_hyperparameters(
     assert model_fn in models_and_tags.keys()
     model_name = models_and_tags[model_fn]
 
+    folds = make_folds(model_fn=model_fn, x=x, y=y, feature_names=feature_names)
+    thread_params = {} if threads_per_fit is None else \
+        get_thread_params(model_fn=model_fn, n_threads=threads_per_fit, native=True)
+
+    # Trials may run in concurrent threads, so the best model is swapped in under a lock. The model is kept here rather
+    # than as a user attribute of the trial, since those must be JSON-serialisable when the study is in a database.
+    best_model_lock = threading.Lock()
+    best_model_so_far = {"score": float("inf"), "model": None, "hyperparameters": None}
+
     def objective(trial: optuna.trial.Trial) -> float:
         """
-        Perform Time series cross validation, fit a pipeline to it (equipped with the)
-        selected model, and return the average error across all cross validation splits.
+        Perform Time series cross validation, fit the selected model to it, and return the average error 
+        across all cross validation splits.
 
         Args:
             trial: The optuna trial that's being optimised.
@@ -109,41 +235,148 @@ def optimise_hyperparameters(
         """
         error_scores = []
         hyperparameters = sample_hyperparameters(model_fn=model_fn, trial=trial)
-        tss = TimeSeriesSplit(n_splits=5)
-        pipeline = make_pipeline(model_fn(**hyperparameters))
 
         logger.warning(f"Starting Trial {trial.number}")
-        # Use TSS to split the features and target variables for training and validation
-        for split_number, (train_indices, val_indices) in enumerate(tss.split(x)):
+        for split_number, (training_set, x_val, y_val) in enumerate(folds):
             logger.info(f"Performing split number {split_number}")
-            x_train, x_val = x.iloc[train_indices], x.iloc[val_indices]
-            y_train, y_val = y.iloc[train_indices], y.iloc[val_indices]
 
             logger.info("Fitting model...")
-            pipeline.fit(x_train, y_train)
+            if model_fn == LGBMRegressor:
+                # The importance type only matters to the scikit-learn interface
+                params = {name: value for name, value in hyperparameters.items() if name != "importance_type"}
+                params = {**params, **get_device_params(model_fn=model_fn), **thread_params}
+
+                # If LightGBM fails on the GPU, later trials go straight to the CPU
+                booster = fit_with_cpu_fallback(
+                    fit=lambda: lgb.train(params=params, train_set=training_set),
+                    fit_on_cpu=(
+                        lambda: lgb.train(params={**params, "device_type": "cpu"}, train_set=training_set)
+                    ) if params.get("device_type") == "gpu" else None
+                )
+
+            elif model_fn == XGBRegressor:
+                # Train for as many rounds as XGBRegressor would by default
+                booster = xgb.train(
+                    params={**hyperparameters, **get_device_params(model_fn=model_fn), **thread_params}, 
+                    dtrain=training_set, 
+                    num_boost_round=100
+                )
+
+            else:
+                # The training data has already been checked for missing values. The setting is applied here rather
+                # than once, because scikit-learn's configuration is local to each thread, and trials run in threads.
+                with config_context(assume_finite=True, working_memory=1024):
+                    booster = model_fn(**hyperparameters).fit(*training_set)
 
             logger.info("Evaluating the performance of the trial...")
-            y_pred = pipeline.predict(X=x_val)
-            error = mean_absolute_error(y_true=y_val, y_pred=y_pred)
+            with config_context(assume_finite=True):
+                y_pred = booster.predict(x_val)
+            error = compute_mean_absolute_error(y_true=y_val, y_pred=y_pred)
             error_scores.append(error)
             logger.info(f"MAE = {error}")
 
+            # Report the running average so that unpromising trials can be abandoned before all splits are done
+            trial.report(value=np.mean(error_scores), step=split_number)
+            if trial.should_prune():
+                logger.warning(f"Pruning Trial {trial.number} after split number {split_number}")
+                raise optuna.TrialPruned()
+
         avg_score = np.mean(error_scores)
+
+        if keep_best_model:
+            with best_model_lock:
+                if avg_score < best_model_so_far["score"]:
+                    best_model_so_far.update(score=avg_score, model=booster, hyperparameters=hyperparameters)
+
         return avg_score
 
     logger.info("Beginning hyperparameter search")
-    sampler = TPESampler(seed=69)
-    study = optuna.create_study(study_name="study", direction="minimize", sampler=sampler, pruner=MedianPruner())
-    study.optimize(func=objective, n_trials=hyperparameter_trials)
+    sampler = TPESampler(seed=69, multivariate=True, group=True)
+
+    study = optuna.create_study(
+        study_name=f"{model_name}-{scenario}",
+        direction="minimize",
+        sampler=sampler,
+        pruner=SuccessiveHalvingPruner(min_resource=1, reduction_factor=3),
+        storage=storage,
+        load_if_exists=True
+    )
+
+    # Stop early once the search stalls. As the study may be shared (through the storage), and resumed, the number
+    # of trials is capped across all processes and runs, rather than per call.
+    callbacks = [
+        EarlyStop(patience=max(5, hyperparameter_trials // 3)),
+        MaxTrialsCallback(n_trials=hyperparameter_trials, states=(TrialState.COMPLETE, TrialState.PRUNED))
+    ]
+
+    study.optimize(
+        func=objective, 
+        n_trials=hyperparameter_trials, 
+        n_jobs=n_jobs, 
+        gc_after_trial=True, 
+        callbacks=callbacks
+    )
+
+    best_model = best_model_so_far["model"]
+
+    if best_model is None:
+        # Get the dictionary of the best hyperparameters and the error that they produce
+        best_hyperparams = study.best_params
+        best_value = study.best_value
+    else:
+        # With a shared or resumed study, its best trial may not be one of the trials that were run by this call. 
+        # The hyperparameters that are reported must be those of the model that is being kept.
+        best_hyperparams = best_model_so_far["hyperparameters"]
+        best_value = best_model_so_far["score"]
 
-    # Get the dictionary of the best hyperparameters and the error that they produce
-    best_hyperparams = study.best_params
-    best_value = study.best_value
+        extra_params = get_device_params(model_fn=model_fn)
+        if threads_per_fit is not None:
+            extra_params.update(get_thread_params(model_fn=model_fn, n_threads=threads_per_fit))
 
-    experiment.log_parameters(best_hyperparams)
-    experiment.log_metric(name="Best MAE Across Trials", value=best_value)
+        best_model = wrap_booster(booster=best_model, hyperparameters={**best_hyperparams, **extra_params})
+
+    # The experiment may be shared by several models, so their entries are distinguished by the model's name
+    experiment.log_parameters(best_hyperparams, prefix=model_name)
+    experiment.log_metric(name=f"{model_name}_Best MAE Across Trials", value=best_value)
 
     logger.info(f"The best hyperparameters for the {model_name} model are: {best_hyperparams}")
     logger.success(f"Best MAE Across Trials: {best_value}")
 
-    return best_hyperparams
+    return best_hyperparams, best_model
+
+
+def wrap_booster(
+        booster: lgb.Booster | xgb.Booster | Lasso, 
+        hyperparameters: dict
+) -> LGBMRegressor | XGBRegressor | Lasso:
+    """
+    Place a booster that was trained through the native interface of LightGBM or XGBoost inside the corresponding
+    scikit-learn estimator, so that it is saved, and makes predictions, in the same way as the other models.
+
+    Args:
+        booster: the trained booster. Anything else (such as a Lasso model) is returned as it is.
+        hyperparameters: the hyperparameters with which the booster was trained
+
+    Returns:
+        LGBMRegressor | XGBRegressor | Lasso: the trained estimator
+    """
+    if isinstance(booster, xgb.Booster):
+        # Unlike the scikit-learn interface, XGBoost's boosters only make predictions on DMatrix objects
+        model = XGBRegressor(**hyperparameters)
+        model.load_model(bytearray(booster.save_raw()))
+        return model
+
+    elif isinstance(booster, lgb.Booster):
+        # LightGBM offers no public way of doing this, so the attributes that LGBMRegressor.fit would set are set here
+        model = LGBMRegressor(**hyperparameters)
+        model._Booster = booster
+        model._n_features = model._n_features_in = booster.num_feature()
+        model._objective = hyperparameters.get("objective", "regression")
+        model._best_iteration = booster.best_iteration
+        model._best_score = booster.best_score
+        model._evals_result = {}
+        model.fitted_ = True
+        return model
+
+    else:
+        return booster
@@ -1,20 +1,91 @@
-import pickle
+import shutil
+import joblib
+import subprocess
 import numpy as np
 import pandas as pd 
 
 from pathlib import Path
+from loguru import logger
 from datetime import datetime
+from functools import lru_cache
+from typing import Callable, TypeVar
 
 from xgboost import XGBRegressor
 from lightgbm import LGBMRegressor
+from lightgbm.basic import LightGBMError
 from sklearn.linear_model import Lasso
 
+from sklearn.base import BaseEstimator
 from sklearn.pipeline import Pipeline
 from sklearn.metrics import mean_absolute_error
 
 from src.setup.paths import TRAINING_DATA, MODELS_DIR, make_fundamental_paths
 
 
+@lru_cache(maxsize=1)
+def detect_gpu() -> bool:
+    """
+    Check whether an NVIDIA GPU is available, by asking nvidia-smi to list the GPUs on the machine. This is 
+    only done once (when the GPU is first asked about during training), rather than whenever the module is imported.
+
+    Returns:
+        bool: whether a GPU was found
+    """
+    if shutil.which("nvidia-smi") is None:
+        return False
+
+    try:
+        result = subprocess.run(["nvidia-smi", "-L"], capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+    return result.returncode == 0 and "GPU" in result.stdout
+
+
+# Set once LightGBM has failed to train on the GPU (for instance, because it was built without GPU support)
+LIGHTGBM_GPU_FAILED = False
+
+
+def disable_lightgbm_gpu() -> None:
+    """
+    Record that LightGBM has failed to train on the GPU, so that the device parameters of any LightGBM models 
+    that are made from now on place them on the CPU.
+    """
+    global LIGHTGBM_GPU_FAILED
+    LIGHTGBM_GPU_FAILED = True
+
+
+Fitted = TypeVar("Fitted")
+
+
+def fit_with_cpu_fallback(fit: Callable[[], Fitted], fit_on_cpu: Callable[[], Fitted] | None) -> Fitted:
+    """
+    Fit a model. If LightGBM fails to train it on the GPU, LightGBM's use of the GPU is disabled (so that later 
+    fits go straight to the CPU), and the model is fitted on the CPU instead.
+
+    Args:
+        fit: a function that fits the model and returns the result
+        fit_on_cpu: a function that fits the model on the CPU and returns the result. This should be None if the 
+                    model isn't being trained on the GPU, in which case any error is raised as it is.
+
+    Returns:
+        Fitted: whatever the fitting function returns (such as the fitted model or booster)
+    """
+    try:
+        return fit()
+    except LightGBMError as error:
+        if fit_on_cpu is None:
+            raise
+
+        logger.warning(f"LightGBM could not train on the GPU ({error}) -> Falling back to the CPU")
+        disable_lightgbm_gpu()
+        return fit_on_cpu()
+
+
+# Model files are read and written through buffers of this size (in bytes), rather than the default of 8KB
+MODEL_FILE_BUFFER_SIZE = 1 << 20
+
+
 class BaseModel:
 
     def __init__(self, scenario: str):
@@ -58,6 +129,112 @@ class BaseModel:
         return mean_absolute_error(y_true=y_true, y_pred=y_pred)
 
 
+def compute_mean_absolute_error(y_true: pd.Series | np.ndarray, y_pred: pd.Series | np.ndarray) -> float:
+    """
+    Compute the mean absolute error using a single float32 buffer: the differences are written into it, and their 
+    absolute values are then taken in place. This avoids the input validation and the extra temporary arrays of 
+    sklearn's implementation, which matters for large test sets.
+
+    Args:
+        y_true: the true values of the target
+        y_pred: the predicted values of the target
+
+    Returns:
+        float: the mean absolute error
+    """
+    errors = np.subtract(
+        np.asarray(y_true, dtype=np.float32).ravel(), 
+        np.asarray(y_pred, dtype=np.float32).ravel()
+    )
+
+    np.abs(errors, out=errors)
+    return float(errors.mean(dtype=np.float64))
+
+
+def get_device_params(model_fn: BaseModel | Lasso | LGBMRegressor | XGBRegressor) -> dict[str, str | bool]:
+    """
+    Provide the parameters that will have the tree boosters build their histograms on the GPU if one is available.
+    Otherwise, XGBoost is told to use its histogram method, which is much quicker than its exact one.
+
+    Args:
+        model_fn: the model architecture to be used
+
+    Returns:
+        dict[str, str | bool]: the parameters, which are to be merged into the model's hyperparameters
+    """
+    if model_fn == LGBMRegressor:
+        use_gpu = not LIGHTGBM_GPU_FAILED and detect_gpu()
+        return {"device_type": "gpu", "gpu_use_dp": False} if use_gpu else {}
+
+    elif model_fn == XGBRegressor:
+        # The GPU predictor is deliberately left out, so that the saved models can still be used on machines 
+        # without a GPU (such as the ones that serve predictions).
+        return {"tree_method": "gpu_hist"} if detect_gpu() else {"tree_method": "hist"}
+
+    else:
+        return {}
+
+
+def get_thread_params(
+    model_fn: BaseModel | Lasso | LGBMRegressor | XGBRegressor, 
+    n_threads: int, 
+    native: bool = False
+) -> dict[str, int]:
+    """
+    Provide the parameters that cap the number of threads that the tree boosters use for each fit. Without them,
+    every fit uses all the cores, which oversubscribes the machine when several fits run at once.
+
+    Args:
+        model_fn: the model architecture to be used
+        n_threads: the number of threads that each fit may use
+        native: whether the parameters are for XGBoost's native interface (xgb.train) rather than its 
+                scikit-learn one. LightGBM accepts the same parameter in both.
+
+    Returns:
+        dict[str, int]: the parameters, which are to be merged into the model's hyperparameters
+    """
+    if model_fn == LGBMRegressor:
+        return {"n_jobs": n_threads}
+    elif model_fn == XGBRegressor:
+        return {"nthread": n_threads} if native else {"n_jobs": n_threads}
+    else:
+        return {}
+
+
+def get_fit_params(model: Pipeline | BaseEstimator, feature_names: list[str]) -> dict[str, list[str]]:
+    """
+    LightGBM models only learn the names of their features during fitting, so when they are trained on 
+    arrays, the names have to be passed to the fit method.
+
+    Args:
+        model: the model that is about to be fitted
+        feature_names: the names of the features, in the order of the columns of the training array
+
+    Returns:
+        dict[str, list[str]]: the keyword arguments to be passed to the model's fit method
+    """
+    return {"feature_name": feature_names} if isinstance(model, LGBMRegressor) else {}
+
+
+def set_feature_names(model: Pipeline | BaseEstimator, feature_names: list[str]) -> None:
+    """
+    Give a model that was fitted on arrays the names of its features, so that it behaves as though it had been 
+    fitted on a dataframe. This should only be done after the model has made its predictions on arrays, as 
+    XGBoost refuses to make predictions on unnamed data once its booster has feature names.
+
+    Args:
+        model: the fitted model
+        feature_names: the names of the features, in the order of the columns of the training array
+    """
+    if isinstance(model, XGBRegressor):
+        model.get_booster().feature_names = feature_names
+    elif isinstance(model, Lasso):
+        model.feature_names_in_ = np.asarray(feature_names, dtype=object)
+    elif isinstance(model, LGBMRegressor) and not hasattr(model, "feature_names_in_"):
+        # Newer versions of LightGBM provide this attribute themselves (from the names given during fitting)
+        model.feature_names_in_ = np.asarray(feature_names, dtype=object)
+
+
 def get_model(model_name: str) -> BaseModel | Lasso | LGBMRegressor | XGBRegressor:
     """
     
@@ -78,7 +255,7 @@ def get_model(model_name: str) -> BaseModel | Lasso | LGBMRegressor | XGBRegress
         return models_and_names[model_name.lower()]
 
 
-def load_local_model(directory: Path, model_name: str, scenario: str, tuned_or_not: str) -> Pipeline:
+def load_local_model(directory: Path, model_name: str, scenario: str, tuned_or_not: str) -> Pipeline | BaseEstimator:
     """
     Allows for model objects that have been downloaded from the model registry, or created locally to be loaded
     and returned for inference or other purpose. It was important that the function be global and that it allow
@@ -92,7 +269,7 @@ def load_local_model(directory: Path, model_name: str, scenario: str, tuned_or_n
                       "untuned".
 
     Returns:
-        Pipeline: the model as an object of the sklearn.pipeline.Pipeline class.
+        Pipeline | BaseEstimator: the model. Only the base model is wrapped in a sklearn.pipeline.Pipeline object.
     """
     if not Path(MODELS_DIR).exists():
         make_fundamental_paths()
@@ -102,5 +279,7 @@ def load_local_model(directory: Path, model_name: str, scenario: str, tuned_or_n
 
     model_file_name = f"{model_name.title()} ({tuned_or_not.title()} for {scenario}s).pkl"
     model_file = directory / model_file_name
-    with open(model_file, "rb") as file:
-        return pickle.load(file)
+
+    # This detects the compression that was used (if any), so models that were pickled without joblib also load.
+    with open(model_file, "rb", buffering=MODEL_FILE_BUFFER_SIZE) as file:
+        return joblib.load(filename=file)
@@ -2,24 +2,40 @@
 Contains code for model training with and without hyperparameter tuning, as well as 
 experiment tracking.
 """
-import pickle
+import os
+import joblib
+import hashlib
 from pathlib import Path
 from argparse import ArgumentParser
 
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
+import pyarrow.feather as feather
 from loguru import logger
+from joblib import Parallel, delayed
+from threadpoolctl import threadpool_limits
 
 from comet_ml import Experiment
 
-from xgboost import XGBRegressor
-from sklearn.metrics import mean_absolute_error
+from sklearn import config_context
+from sklearn.base import BaseEstimator
 from sklearn.pipeline import Pipeline, make_pipeline
 
 from src.setup.config import config
 from src.setup.paths import TRAINING_DATA, LOCAL_SAVE_DIR, make_fundamental_paths
 from src.feature_pipeline.preprocessing import DataProcessor
 from src.inference_pipeline.backend.model_registry_api import ModelRegistry
-from src.training_pipeline.models import get_model
+from src.training_pipeline.models import (
+    MODEL_FILE_BUFFER_SIZE, 
+    get_model, 
+    get_device_params, 
+    get_thread_params, 
+    get_fit_params, 
+    fit_with_cpu_fallback, 
+    set_feature_names, 
+    compute_mean_absolute_error
+)
 from src.training_pipeline.hyperparameter_tuning import optimise_hyperparameters
 
 
@@ -28,7 +44,10 @@ class Trainer:
         self,
         scenario: str,
         hyperparameter_trials: int,
-        tune_hyperparameters: bool | None = True
+        tune_hyperparameters: bool | None = True,
+        n_jobs: int = 1,
+        storage: str | None = None,
+        refit: bool = True
     ):
         """
         Args:
@@ -38,40 +57,125 @@ class Trainer:
             tune_hyperparameters (bool | None, optional): whether to tune hyperparameters or not.
 
             hyperparameter_trials (int | None): the number of times that we will try to optimize the hyperparameters
+
+            n_jobs (int, optional): the number of hyperparameter trials to run in parallel (for each model). 
+                                    Defaults to 1, since the models themselves are trained concurrently. 
+                                    Passing -1 runs one trial per CPU core.
+
+            storage (str | None, optional): the URL of the database in which Optuna studies are to be stored. Several
+                                            training processes that share the same storage will split the trials of
+                                            a study between them. Defaults to None (in-memory storage).
+
+            refit (bool, optional): whether to fit a model with the best hyperparameters on all the training data 
+                                    after tuning. If False, the model that the best trial trained during cross 
+                                    validation is used instead, which saves a full round of training but leaves 
+                                    out the most recent part of the training data. Defaults to True.
         """
+        scenario = scenario.lower()
+        assert scenario in ("start", "end"), 'The scenario must be either "start" or "end"'
+
         self.scenario = scenario
         self.tune_hyperparameters = tune_hyperparameters
         self.hyperparameter_trials = hyperparameter_trials
+        self.n_jobs = n_jobs
+        self.storage = storage
+        self.refit = refit
         self.tuned_or_not = "Tuned" if self.tune_hyperparameters else "Untuned"
+        self._cached_data: tuple[pd.DataFrame, pd.Series] | None = None
+        self._data_fingerprint: str | None = None
         make_fundamental_paths()  # Ensure that all the necessary directories exist.
 
     def get_or_make_training_data(self) -> tuple[pd.DataFrame, pd.Series]:
         """
-        Fetches or builds the training data for the starts or ends of trips.
+        Fetches or builds the training data for the starts or ends of trips. The result (and its fingerprint) 
+        is kept on the instance, so the data is only read, sorted and hashed once, however many models are trained.
 
         Returns:
             pd.DataFrame: a tuple containing the training data's features and targets
         """
-        assert self.scenario.lower() in ["start", "end"]
+        if self._cached_data is not None:
+            return self._cached_data
+
+        arrow_path = TRAINING_DATA / f"{self.scenario}s.arrow"
         data_path = TRAINING_DATA / f"{self.scenario}s.parquet"
-        
-        if Path(data_path).is_file():
-            training_data = pd.read_parquet(path=data_path)
+
+        # The Arrow IPC copy is only trusted if it is newer than the parquet file. Otherwise, regenerating (or deleting)
+        # the parquet file would leave stale data to be used without any warning.
+        arrow_is_current = Path(arrow_path).is_file() and Path(data_path).is_file() and \
+            Path(arrow_path).stat().st_mtime >= Path(data_path).stat().st_mtime
+
+        if arrow_is_current:
+            # The uncompressed Arrow IPC file is memory-mapped, rather than decoded in full as a parquet file would be
+            training_data = feather.read_table(source=arrow_path, memory_map=True).to_pandas(
+                self_destruct=True, 
+                split_blocks=True
+            )
+
+            logger.success(f"Fetched saved training data for {config.displayed_scenario_names[self.scenario].lower()}")
+
+        elif Path(data_path).is_file():
+            # Read the columns on multiple threads, and free each Arrow column as soon as it has been converted
+            training_data = pq.read_table(source=data_path, use_threads=True).to_pandas(
+                self_destruct=True, 
+                split_blocks=True
+            )
+
+            # Keep an Arrow IPC copy, so that later runs can take the quicker route above
+            training_data.to_feather(arrow_path, compression="uncompressed")
             logger.success(f"Fetched saved training data for {config.displayed_scenario_names[self.scenario].lower()}")
         else:
             logger.warning("No training data is stored. Creating the dataset will take a while. Watch some One Piece.")
 
             processor = DataProcessor(year=config.year, for_inference=False)
             training_sets = processor.make_training_data(geocode=False)
-            training_data = training_sets[0] if self.scenario.lower() == "start" else training_sets[1]
+            training_data = training_sets[0 if self.scenario == "start" else 1]
             
             logger.success("Training data produced successfully")
 
+        training_data = self.downcast_numeric_columns(data=training_data)
+
+        # Check for missing values once here, so that scikit-learn can be told not to check on every fit and predict
+        assert training_data.notna().all().all(), "The training data contains missing values"
+
+        # Sort once, before separating the features from the target, rather than sorting each of them
+        training_data = training_data.sort_index(kind="mergesort")
         target = training_data["trips_next_hour"]
-        features = training_data.drop("trips_next_hour", axis=1)
-        return features.sort_index(), target.sort_index()
+        features = training_data.drop(columns="trips_next_hour")
 
-    def train(self, model_name: str) -> float:
+        self._cached_data = features, target
+        self._data_fingerprint = self.fingerprint_data(features=features, target=target)
+        return features, target
+
+    @staticmethod
+    def downcast_numeric_columns(data: pd.DataFrame) -> pd.DataFrame:
+        """
+        Convert 64-bit floats to float32, and 64-bit integers to int32 wherever their values fit. The tree 
+        boosters bin the features anyway, so the extra precision is of no use, while halving the size of 
+        the columns halves the number of bytes that are moved during fitting and prediction.
+
+        Args:
+            data (pd.DataFrame): the training data
+
+        Returns:
+            pd.DataFrame: the training data, with its numeric columns downcast
+        """
+        int32_limits = np.iinfo(np.int32)
+        new_dtypes = {column: np.float32 for column in data.select_dtypes(include="float64").columns}
+
+        for column in data.select_dtypes(include="int64").columns:
+            if int32_limits.min <= data[column].min() and data[column].max() <= int32_limits.max:
+                new_dtypes[column] = np.int32
+
+        return data.astype(new_dtypes, copy=False) if new_dtypes else data
+
+    def train(
+        self, 
+        model_name: str, 
+        experiment: Experiment | None = None,
+        features: pd.DataFrame | None = None,
+        target: pd.Series | None = None,
+        threads_per_fit: int | None = None
+    ) -> float:
         """
         The function first checks for the existence of the training data, and builds it if
         it doesn't find it locally. Then it checks for a saved model. If it doesn't find a model,
@@ -79,79 +183,286 @@ class Trainer:
 
         Args:
             model_name (str): the name of the model to be trained
+            experiment (Experiment | None, optional): a running CometML experiment to log to. If none is provided,
+                                                      an experiment will be created (and ended) for this model alone.
+            features (pd.DataFrame | None, optional): the features of the training data. If they (or the target) 
+                                                      aren't provided, the training data will be fetched or built.
+            target (pd.Series | None, optional): the target of the training data.
+            threads_per_fit (int | None, optional): the number of threads that each fit of a tree booster may use.
+                                                    If not provided, the cores are divided between the concurrent
+                                                    hyperparameter trials.
 
         Returns:
             float: the error of the chosen model on the test dataset.
         """
         model_fn: callable = get_model(model_name=model_name)
-        features, target = self.get_or_make_training_data()
+        if features is None or target is None:
+            features, target = self.get_or_make_training_data()
 
+        if threads_per_fit is None:
+            threads_per_fit = self.get_threads_per_fit(concurrent_models=1)
+
+        thread_params = get_thread_params(model_fn=model_fn, n_threads=threads_per_fit)
+        feature_names = features.columns.tolist()
         train_sample_size = int(0.9 * len(features))
-        x_train, x_test = features[:train_sample_size], features[train_sample_size:]
-        y_train, y_test = target[:train_sample_size], target[train_sample_size:]
 
-        experiment = Experiment(
-            api_key=config.comet_api_key,
-            workspace=config.comet_workspace,
-            project_name=config.comet_project_name
-        )
-        
+        owns_experiment = experiment is None
+        if owns_experiment:
+            experiment = self.start_experiment(
+                name=f"{model_name.title()}({self.tuned_or_not}) model for the {self.scenario}s of trips"
+            )
+
+        experiment.log_parameter(name=f"{model_name}_tuned_or_not", value=self.tuned_or_not)
+
+        # The fingerprint of the instance's own training data was taken when it was loaded. Other data is hashed here.
+        if self._cached_data is not None and features is self._cached_data[0] and target is self._cached_data[1]:
+            data_fingerprint = self._data_fingerprint
+        else:
+            data_fingerprint = self.fingerprint_data(features=features, target=target)
+
+        cache_key = self.make_cache_key(model_name=model_name, data_fingerprint=data_fingerprint)
+        cached_model = self.load_cached_model(model_name=model_name, cache_key=cache_key)
+
+        if cached_model is not None:
+            logger.info(f"Found a saved {model_name} model that was trained on the same data -> Skipping training")
+
+            # Saved models carry the names of their features, so they are given named test data.
+            test_error = compute_mean_absolute_error(
+                y_true=target.iloc[train_sample_size:], 
+                y_pred=cached_model.predict(features.iloc[train_sample_size:])
+            )
+
+            experiment.log_metric(name=f"{model_name}_Test_MAE", value=test_error)
+
+            if owns_experiment:
+                experiment.end()
+
+            return test_error
+
+        if model_name == "base":
+            # The base model looks up the "trips_previous_1_hour" column by name, so it needs dataframes. 
+            # Slice by position. With a non-range index, [] slicing would be interpreted in terms of labels.
+            x_train, x_test = features.iloc[:train_sample_size], features.iloc[train_sample_size:]
+            y_train, y_test = target.iloc[:train_sample_size], target.iloc[train_sample_size:]
+        else:
+            # Convert the data to float32 arrays once, and split them into views. This avoids building new indices
+            # and copying the feature block for each split, and halves the bytes that are moved during fitting.
+            x = features.to_numpy(dtype=np.float32, copy=False)
+            y = target.to_numpy(dtype=np.float32, copy=False)
+            x_train, x_test = x[:train_sample_size], x[train_sample_size:]
+            y_train, y_test = y[:train_sample_size], y[train_sample_size:]
+
+        best_model = None
         if not self.tune_hyperparameters:
-            experiment.set_name(name=f"{model_name.title()}(Untuned) model for the {self.scenario}s of trips")
             logger.info("Using the default hyperparameters")
 
+            # The base model isn't a scikit-learn estimator, so it is the only model that is still wrapped in a 
+            # pipeline. The other models are used directly, as a pipeline with a single step only adds overhead.
             if model_name == "base":
-                pipeline = make_pipeline(
+                model = make_pipeline(
                     model_fn(scenario=self.scenario)
                 )
             else:
-                if isinstance(model_fn, XGBRegressor):
-                    pipeline = make_pipeline(model_fn)
-                else:
-                    pipeline = make_pipeline(model_fn())
+                model = model_fn(**get_device_params(model_fn=model_fn), **thread_params)
         else:
-            experiment.set_name(name=f"{model_name.title()}(Tuned) model for the {self.scenario}s of trips")
             logger.info(
                 f"Tuning hyperparameters of the {model_name} model. Have a snack and watch One Piece (it's fantastic)"
             )
 
-            best_model_hyperparameters = optimise_hyperparameters(
+            best_model_hyperparameters, best_model = optimise_hyperparameters(
                 model_fn=model_fn,
                 hyperparameter_trials=self.hyperparameter_trials,
                 experiment=experiment,
                 x=x_train,
-                y=y_train
+                y=y_train,
+                scenario=self.scenario,
+                n_jobs=self.n_jobs,
+                storage=self.storage,
+                keep_best_model=not self.refit,
+                feature_names=feature_names,
+                threads_per_fit=threads_per_fit
             )
 
             logger.success(f"Best model hyperparameters {best_model_hyperparameters}")
             
-            pipeline = make_pipeline(
-                model_fn(**best_model_hyperparameters)
-            )
+            if best_model is not None:
+                model = best_model
+            else:
+                model = model_fn(
+                    **best_model_hyperparameters, 
+                    **get_device_params(model_fn=model_fn), 
+                    **thread_params
+                )
 
-        logger.info("Fitting model...")
+        # The data was checked for missing values when it was loaded
+        with config_context(assume_finite=True, working_memory=1024):
+            if best_model is not None:
+                logger.info("Using the model of the best trial, without refitting it")
+            else:
+                logger.info("Fitting model...")
+                fit_params = get_fit_params(model=model, feature_names=feature_names)
+                on_gpu = model.get_params().get("device_type") == "gpu"
+
+                model = fit_with_cpu_fallback(
+                    fit=lambda: model.fit(x_train, y_train, **fit_params),
+                    fit_on_cpu=(
+                        lambda: model.set_params(device_type="cpu").fit(x_train, y_train, **fit_params)
+                    ) if on_gpu else None
+                )
 
-        pipeline.fit(X=x_train, y=y_train)
-        y_pred = pipeline.predict(x_test)
-        test_error = mean_absolute_error(y_true=y_test, y_pred=y_pred)
+            y_pred = model.predict(x_test)
 
-        self.save_model_locally(model_fn=pipeline, model_name=model_name)
-        experiment.log_metric(name="Test M.A.E", value=test_error)
-        experiment.end()
+        test_error = compute_mean_absolute_error(y_true=y_test, y_pred=y_pred)
+
+        # Arrays carry no column names, so the model is told the names of its features before it is saved. The 
+        # inference pipeline relies on these names to select and order the features.
+        set_feature_names(model=model, feature_names=feature_names)
+        self.save_model_locally(model_fn=model, model_name=model_name, cache_key=cache_key)
+        experiment.log_metric(name=f"{model_name}_Test_MAE", value=test_error)
+
+        if owns_experiment:
+            experiment.end()
         
         return test_error
 
-    def save_model_locally(self, model_fn: Pipeline, model_name: str):
+    def get_threads_per_fit(self, concurrent_models: int) -> int:
+        """
+        Divide the CPU cores between the fits that will run at the same time, which are those of the models 
+        being trained concurrently, and those of the hyperparameter trials that each model runs in parallel.
+
+        Args:
+            concurrent_models (int): the number of models that are being trained at the same time
+
+        Returns:
+            int: the number of threads that each fit may use
+        """
+        n_cores = os.cpu_count() or 1
+
+        if not self.tune_hyperparameters:
+            concurrent_trials = 1
+        else:
+            concurrent_trials = n_cores if self.n_jobs == -1 else max(1, self.n_jobs)
+
+        return max(1, n_cores // (concurrent_models * concurrent_trials))
+
+    @staticmethod
+    def start_experiment(name: str) -> Experiment:
+        """
+        Start a CometML experiment with the given name.
+
+        Args:
+            name (str): the name to be given to the experiment
+
+        Returns:
+            Experiment: the running experiment
+        """
+        experiment = Experiment(
+            api_key=config.comet_api_key,
+            workspace=config.comet_workspace,
+            project_name=config.comet_project_name
+        )
+
+        experiment.set_name(name=name)
+        return experiment
+
+    @staticmethod
+    def fingerprint_data(features: pd.DataFrame, target: pd.Series) -> str:
         """
-        Save the trained model locally as a .pkl file
+        Produce a hash of the training data, to which every value (and index label) contributes, along with 
+        the names and types of the columns.
 
         Args:
-            model_fn (Pipeline): the model object to be stored
+            features (pd.DataFrame): the features of the training data
+            target (pd.Series): the target of the training data
+
+        Returns:
+            str: the hexadecimal digest of the hash
+        """
+        fingerprint = hashlib.blake2b(digest_size=16)
+        fingerprint.update(f"{list(features.columns)}-{list(features.dtypes.astype(str))}".encode())
+        fingerprint.update(pd.util.hash_pandas_object(features, index=True).to_numpy().tobytes())
+        fingerprint.update(pd.util.hash_pandas_object(target, index=False).to_numpy().tobytes())
+        return fingerprint.hexdigest()
+
+    def make_cache_key(self, model_name: str, data_fingerprint: str) -> str:
+        """
+        Produce a short hash that identifies the data that a model is trained on, the manner in which it is 
+        trained, and the version of the training code. A saved model whose key matches this one need not be 
+        trained again.
+
+        Args:
+            model_name (str): the name of the model
+            data_fingerprint (str): the hash of the training data, as produced by fingerprint_data
+
+        Returns:
+            str: the hexadecimal digest of the hash
+        """
+        trials = self.hyperparameter_trials if self.tune_hyperparameters else 0
+        refit = self.refit if self.tune_hyperparameters else True
+        device_params = get_device_params(model_fn=get_model(model_name=model_name))
+
+        key = hashlib.blake2b(digest_size=8)
+        key.update(f"{model_name}-{self.tuned_or_not}-{trials}-{refit}-{sorted(device_params.items())}".encode())
+
+        # Changes to the training code (such as the search spaces of the hyperparameters) also invalidate the models
+        for module_path in sorted(Path(__file__).parent.glob("*.py")):
+            key.update(module_path.read_bytes())
+
+        key.update(data_fingerprint.encode())
+        return key.hexdigest()
+
+    def load_cached_model(self, model_name: str, cache_key: str) -> Pipeline | BaseEstimator | None:
+        """
+        Load the locally saved version of the named model, provided that it was trained under the 
+        circumstances described by the given cache key.
+
+        Args:
+            model_name (str): the name of the model
+            cache_key (str): the key produced by make_cache_key
+
+        Returns:
+            Pipeline | BaseEstimator | None: the saved model, or None if there is no suitable saved model.
+        """
+        model_path = LOCAL_SAVE_DIR/self.get_model_file_name(model_name=model_name)
+        key_path = model_path.with_suffix(".key")
+
+        if model_path.is_file() and key_path.is_file() and key_path.read_text().strip() == cache_key:
+            with open(model_path, "rb", buffering=MODEL_FILE_BUFFER_SIZE) as file:
+                return joblib.load(filename=file)
+
+    def get_model_file_name(self, model_name: str) -> str:
+        """
+        Provide the name of the file in which the named model is saved locally. The model registry expects 
+        models to be saved under this name.
+
+        Args:
+            model_name (str): the name of the model
+
+        Returns:
+            str: the name of the model's file
+        """
+        return f"{model_name.title()} ({self.tuned_or_not} for {self.scenario}s).pkl"
+
+    def save_model_locally(self, model_fn: Pipeline | BaseEstimator, model_name: str, cache_key: str | None = None):
+        """
+        Save the trained model locally as an LZ4-compressed .pkl file. If a cache key is provided, it is 
+        written to a .key file of the same name, so that the model can be reused instead of being retrained.
+
+        Args:
+            model_fn (Pipeline | BaseEstimator): the model object to be stored
             model_name (str): the name of the model to be saved
+            cache_key (str | None, optional): the key produced by make_cache_key
         """
-        model_file_name = f"{model_name.title()} ({self.tuned_or_not} for {self.scenario}s).pkl"
-        with open(LOCAL_SAVE_DIR/model_file_name, mode="wb") as file:
-            pickle.dump(obj=model_fn, file=file)
+        model_path = LOCAL_SAVE_DIR/self.get_model_file_name(model_name=model_name)
+
+        # Protocol 5 serialises numpy arrays far more efficiently, and LZ4 compresses them with little overhead. 
+        # The file is given a 1MB buffer so that the many small writes of the pickle stream are batched.
+        with open(model_path, "wb", buffering=MODEL_FILE_BUFFER_SIZE) as file:
+            joblib.dump(value=model_fn, filename=file, compress=("lz4", 3), protocol=5)
+
+        # The key is kept in a separate file, because the model registry expects the name of the model file to be fixed
+        if cache_key is not None:
+            model_path.with_suffix(".key").write_text(cache_key)
 
         logger.success("Saved model to disk")
 
@@ -165,19 +476,53 @@ class Trainer:
             version: the version of the registered model on CometML.
             status:  the registered status of the model on CometML.
         """
-        models_and_errors = {}
         assert status.lower() in ["staging", "production"], 'The status must be either "staging" or "production"'
-        
-        for model_name in model_names:
-            test_error = self.train(model_name=model_name)
-            models_and_errors[model_name] = test_error
 
-        test_errors = models_and_errors.values()
-        for model_name in model_names:
-            if models_and_errors[model_name] == min(test_errors):
-                logger.info(f"The best performing model is {model_name} -> Pushing it to the CometML model registry")
-                registry = ModelRegistry(model_name=model_name, scenario=self.scenario, tuned_or_not=self.tuned_or_not)
-                registry.push_model_to_registry(status=status.title(), version=version)
+        # A single experiment is shared by all the models, rather than one being set up for each of them.
+        experiment = self.start_experiment(name=f"{self.tuned_or_not} models for the {self.scenario}s of trips")
+
+        # Fetch the data before the threads start, so that they all share one copy of it
+        features, target = self.get_or_make_training_data()
+
+        concurrent_models = min(len(model_names), os.cpu_count() or 1)
+        threads_per_fit = self.get_threads_per_fit(concurrent_models=concurrent_models)
+
+        def _train(model_name: str) -> tuple[str, float]:
+            test_error = self.train(
+                model_name=model_name, 
+                experiment=experiment, 
+                features=features, 
+                target=target, 
+                threads_per_fit=threads_per_fit
+            )
+
+            return model_name, test_error
+
+        # The models are trained concurrently. Threads are used rather than processes because the estimators release 
+        # the GIL while fitting, and because this avoids making a copy of the training data for each process.
+        # Results arrive as each model finishes, so the best model is tracked as we go rather than searched for later.
+        # The boosters are told how many threads to use, and the native thread pools (BLAS and OpenMP) are capped 
+        # in the same way, so that the concurrent fits don't oversubscribe the cores between them.
+        with threadpool_limits(limits=threads_per_fit):
+            results = Parallel(
+                n_jobs=concurrent_models, 
+                backend="threading", 
+                return_as="generator_unordered"
+            )(
+                delayed(_train)(model_name=model_name) for model_name in model_names
+            )
+
+            best_model_name, best_test_error = None, float("inf")
+            for model_name, test_error in results:
+                logger.info(f"Test MAE of the {model_name} model: {test_error}")
+                if test_error < best_test_error:
+                    best_model_name, best_test_error = model_name, test_error
+
+        logger.info(f"The best performing model is {best_model_name} -> Pushing it to the CometML model registry")
+        registry = ModelRegistry(model_name=best_model_name, scenario=self.scenario, tuned_or_not=self.tuned_or_not)
+        registry.push_model_to_registry(status=status.title(), version=version, experiment=experiment)
+
+        experiment.end()
 
 
 if __name__ == "__main__":
@@ -186,12 +531,18 @@ if __name__ == "__main__":
     parser.add_argument("--models", type=str, nargs="+", required=True)
     parser.add_argument("--tune_hyperparameters", action="store_true")
     parser.add_argument("--hyperparameter_trials", type=int, default=15)
+    parser.add_argument("--n_jobs", type=int, default=1)
+    parser.add_argument("--storage", type=str, default=None)
+    parser.add_argument("--skip_refit", action="store_true")
     args = parser.parse_args()
 
     trainer = Trainer(
         scenario=args.scenario,
         tune_hyperparameters=args.tune_hyperparameters,
-        hyperparameter_trials=args.hyperparameter_trials
+        hyperparameter_trials=args.hyperparameter_trials,
+        n_jobs=args.n_jobs,
+        storage=args.storage,
+        refit=not args.skip_refit
     )
 
     trainer.train_and_register_models(model_names=args.models, version="1.0.0", status="production")
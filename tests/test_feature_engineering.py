@@ -0,0 +1,31 @@
+import unittest
+import numpy as np
+import pandas as pd 
+
+from src.feature_pipeline.feature_engineering import add_avg_trips_last_4_weeks
+
+
+class CheckAverageTripsLast4Weeks(unittest.TestCase):
+
+    def setUp(self):
+        input_seq_len = 4 * 7 * 24
+        self.lag_matrix = np.random.default_rng(seed=69).integers(0, 50, size=(5, input_seq_len)).astype(np.float32)
+
+        # The oldest hours come first, as they do in the training data
+        self.features = pd.DataFrame(
+            data=self.lag_matrix,
+            columns=[f"trips_previous_{i + 1}_hour" for i in reversed(range(input_seq_len))]
+        )
+
+    def test_lag_matrix_matches_column_names(self):
+        from_columns = add_avg_trips_last_4_weeks(features=self.features)
+        from_lag_matrix = add_avg_trips_last_4_weeks(features=self.features, lag_matrix=self.lag_matrix)
+
+        np.testing.assert_allclose(
+            actual=from_lag_matrix["average_trips_last_4_weeks"].to_numpy(),
+            desired=from_columns["average_trips_last_4_weeks"].to_numpy()
+        )
+
+    def test_short_lag_matrix_is_rejected(self):
+        with self.assertRaises(ValueError):
+            add_avg_trips_last_4_weeks(features=self.features, lag_matrix=self.lag_matrix[:, 1:])
@@ -0,0 +1,42 @@
+import unittest
+import joblib
+import tempfile
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+
+from pathlib import Path
+
+from src.training_pipeline.models import set_feature_names
+from src.training_pipeline.hyperparameter_tuning import wrap_booster
+
+
+class CheckWrappedLightGBMBooster(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(seed=69)
+        self.feature_names = [f"trips_previous_{i + 1}_hour" for i in reversed(range(5))]
+        self.x = rng.random(size=(200, len(self.feature_names)))
+        self.y = self.x @ rng.random(size=len(self.feature_names)) + rng.normal(scale=0.1, size=len(self.x))
+
+        self.hyperparameters = {"num_leaves": 7, "learning_rate": 0.1, "verbose": -1}
+        self.booster = lgb.train(params=self.hyperparameters, train_set=lgb.Dataset(data=self.x, label=self.y))
+
+        self.model = wrap_booster(booster=self.booster, hyperparameters=self.hyperparameters)
+        set_feature_names(model=self.model, feature_names=self.feature_names)
+
+    def test_predictions_match_the_booster(self):
+        np.testing.assert_allclose(actual=self.model.predict(self.x), desired=self.booster.predict(self.x))
+
+    def test_feature_names_are_set(self):
+        self.assertListEqual(list(self.model.feature_names_in_), self.feature_names)
+
+    def test_model_survives_joblib_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            model_path = Path(directory) / "lightgbm.pkl"
+            joblib.dump(self.model, model_path)
+            loaded_model = joblib.load(model_path)
+
+        features = pd.DataFrame(data=self.x, columns=self.feature_names)
+        np.testing.assert_allclose(actual=loaded_model.predict(features), desired=self.booster.predict(self.x))
+        self.assertListEqual(list(loaded_model.feature_names_in_), self.feature_names)